@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+binned rasterization of x/y columns for the density view of a plot tab.
+
+Instead of sending every row to the browser, the rows are counted in a 2D
+grid sized to the plot in pixels. The payload sent to the client is then a
+single image whose size depends on the plot dimensions only, whatever the
+number of rows of the table.
+"""
+
+import numpy as np
+
+
+def data_bounds(x, y):
+    """return ((xmin, xmax), (ymin, ymax)) of finite values, never empty"""
+    bounds = []
+    for values in (x, y):
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            lo, hi = 0., 1.
+        else:
+            lo, hi = float(values.min()), float(values.max())
+        if lo == hi:
+            lo, hi = lo - 0.5, hi + 0.5
+        bounds.append((lo, hi))
+    return tuple(bounds)
+
+
+def bin_xy(x, y, x_range, y_range, width, height):
+    """count (x, y) points in a height*width grid covering x_range, y_range
+
+    x and y are 1D float arrays of same length. x_range and y_range are
+    (start, end) tuples. Points outside the ranges or not finite are ignored.
+    Returns an int64 array of shape (height, width), row 0 being the lowest
+    y bin as expected by the bokeh Image glyph.
+    """
+    x0, x1 = x_range
+    y0, y1 = y_range
+    if x1 < x0:
+        x0, x1 = x1, x0
+    if y1 < y0:
+        y0, y1 = y1, y0
+    if x1 == x0 or y1 == y0:
+        return np.zeros((height, width), dtype=np.int64)
+
+    #scale to bin coordinates; comparisons with nan are False so non finite
+    #values are dropped by the mask
+    with np.errstate(invalid='ignore'):
+        fx = (x - x0) * (width / (x1 - x0))
+        fy = (y - y0) * (height / (y1 - y0))
+        mask = (fx >= 0) & (fx <= width) & (fy >= 0) & (fy <= height)
+    ix = fx[mask].astype(np.int64)
+    iy = fy[mask].astype(np.int64)
+    #points exactly on the upper edge belong to the last bin
+    np.minimum(ix, width - 1, out=ix)
+    np.minimum(iy, height - 1, out=iy)
+
+    counts = np.bincount(iy * width + ix, minlength=width * height)
+    return counts.reshape(height, width)
+
+
+def density_image_data(x, y, x_range, y_range, width, height):
+    """return the ColumnDataSource data of an Image glyph showing the density
+
+    Empty bins are set to nan so that they are drawn with the nan color of
+    the color mapper (transparent), leaving the background visible.
+    """
+    counts = bin_xy(x, y, x_range, y_range, width, height)
+    image = counts.astype(np.float64)
+    image[counts == 0] = np.nan
+    x0, x1 = sorted(x_range)
+    y0, y1 = sorted(y_range)
+    return {'image': [image],
+            'x': [x0],
+            'y': [y0],
+            'dw': [x1 - x0],
+            'dh': [y1 - y0],
+            }
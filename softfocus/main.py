@@ -30,8 +30,13 @@ By default, this template creates 16 csv files contaning random values.
 
 Some functionalities of this template:
     - list csv files and their info in a main tab
+    - watch the folder and update the main tab as csv files are added, 
+    removed or modified (uses inotify_simple if installed)
     - plot the content of a selected csv file, selecting x-axis, y-axis and 
     optionaly a secondary y-axis
+    - read only a window of large csv files sorted along time, using a
+    byte offset index saved next to them (file.csv.idx)
+    - density view of large tables, binned on the server and redrawn on zoom
     - filter or use a custom script on the content
     - download in Excel format the transformed table (javascript 
     implementation)
@@ -65,6 +70,9 @@ from bokeh.models import (Button,
                           CustomJS,  
                           Plot, 
                           Line, 
+                          Image,
+                          Range1d,
+                          LogColorMapper,
                           BasicTicker, 
                           Title,
                           Spacer,
@@ -91,13 +99,18 @@ from bokeh.io import curdoc
 #from bokeh.document import without_document_lock
 
 #local imports
-
+from density import data_bounds, density_image_data
+import sessions
+import watcher
+from rowindex import RowIndex
 
 #other tools
 import pandas as pd
+import numpy as np
 #from datetime import date as datetype
 import time
 from datetime import date, timedelta
+from functools import partial
 
 #from flask import Flask, make_response, Response, send_file
 #app = Flask(__name__)
@@ -113,10 +126,24 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.addHandler(file_handler)
 
+#the folder watcher is shared by all sessions, log in the last session's file
+watcher.logger.setLevel(logging.DEBUG)
+watcher.logger.handlers = [file_handler]
+
 
 
 CURRENT_DIR = os.path.dirname(__file__)
 
+#bytes of plot data a session may hold before the least recently viewed
+#tabs are evicted from memory. A tab showing a plot counts twice the size of
+#its table, the plot source holding a copy of the plotted data
+SESSION_MEMORY_BUDGET = 512*1024**2
+
+#csv files larger than this many bytes are not read entirely when a plot tab
+#is opened, only a window of about WINDOW_ROWS rows of their sorted column
+LARGE_CSV_SIZE = 100*1024**2
+WINDOW_ROWS = 10**6
+
 class SoftFocus(object):
     """class to view and process bokeh sample data using a bokeh server.
     
@@ -153,7 +180,8 @@ class SoftFocus(object):
         
         #dicts hold data from all opened tabs
         self.plot_dfs = dict()
-        
+        self.tab_last_view = dict()#time at which each tab was last viewed
+        self.plot_windows = dict()#window read of each tab, None if whole file
         
         
     def create(self):
@@ -198,39 +226,31 @@ class SoftFocus(object):
         """
         create softfocus instance based on folder data
         """
-        #list only csv files, populate a dict with general info about the files
+        #the catalog lists the csv files with general info about them. It is
+        #shared by all sessions and kept up to date by a background watcher
         logger.info('Database in a csv folder: {0}'.format(data_dir))
-        list_dir = os.listdir(data_dir)
-        csv_dic = {'CSV': [csv for csv in list_dir if csv.endswith('.csv')],
-                   'size (kB)':[],
-                   'last modification':[],
-                   'number of columns':[],
-                   }
-        if len(csv_dic)<1:
-            logger.warning("no csv file found in folder. Exit")
-            sys.exit(0)
-        
-        
-        for csv in csv_dic['CSV']:
-            csv_stat = os.stat(os.path.join(data_dir,csv))
-            csv_dic['size (kB)'].append(csv_stat.st_size/1024)
-            csv_dic['last modification'].append(
-                                     date.fromtimestamp(csv_stat.st_mtime)
-                                     )
-            with open(os.path.join(data_dir,csv),'rb') as f:
-                csv_dic['number of columns'].append(
-                                    len(f.readline().decode().split(','))
-                                    )
+        self.watcher = watcher.get_watcher(data_dir)
+        #register before reading the catalog so that no diff is missed, the
+        #diffs already in the catalog read are skipped by their version.
+        #Registering also lets server_lifecycle free the data of the session
+        self.session_id = str(self.document.session_context._id)
+        sessions.register(self.session_id, self)
+        self.catalog_version, self.df = self.watcher.versioned_catalog()
+        if len(self.df)<1:
+            #rows are streamed by the watcher as files appear
+            logger.warning("no csv file found in folder yet")
             
-        #make bokeh source from the dic
-        self.df = pd.DataFrame(csv_dic)
+        #make bokeh source from the catalog
         self.main_source = ColumnDataSource(self.df)
         
         
         ####  some widgets to filter the table ####
         #date selector
-        last_date = self.df['last modification'].max() 
-        first_date = self.df['last modification'].min()
+        if len(self.df):
+            last_date = self.df['last modification'].max() 
+            first_date = self.df['last modification'].min()
+        else:
+            last_date = first_date = date.today()
         if last_date == first_date:
             last_date = first_date + timedelta(days=1)
         self.date_slider = DateRangeSlider(title='Start date',
@@ -293,6 +313,10 @@ class SoftFocus(object):
         #after coming back to this main tab
         self.tabs.on_change('active',
                             self.changed_tab_cb)
+        #free the data of a tab once closed, either with its exit button or
+        #with the close button of the tab itself
+        self.tabs.on_change('tabs',
+                            self.changed_tabs_cb)
         
         #add a status text above all tabs
         self.info_text = Div(text='<font color="green">ready.</font>',
@@ -346,6 +370,38 @@ class SoftFocus(object):
         """
         if new ==0:#main tab
             self.update()
+        else:
+            self.view_plot_tab(self.tabs.tabs[new])
+    
+    
+    def changed_tabs_cb(self, attr, old, new):
+        """
+        Callback called when tabs are added or closed
+        """
+        open_tests = set(tab.name for tab in new)
+        freed = 0
+        for tab in old:
+            if tab.name not in open_tests:
+                freed += self._tab_memory(tab.name, old)
+                self._free_plot_df(tab.name)
+                self.tab_last_view.pop(tab.name, None)
+                self.plot_windows.pop(tab.name, None)
+        if freed:
+            logger.info('tab closed, {0:.1f} kB freed'.format(freed/1024))
+    
+    
+    @_wait_message_decorator
+    def view_plot_tab(self, plot_tab):
+        """
+        Mark a plot tab as viewed, reload its table if it was evicted
+        """
+        test = plot_tab.name
+        self.tab_last_view[test] = time.time()
+        if test not in self.plot_dfs:
+            logger.info("reloading evicted {0}".format(test))
+            self._load_plot_df(test, self.plot_windows.get(test))
+            self.create_plot_figure(plot_tab)
+            self._enforce_memory_budget(keep=test)
     
     
     #call function when selection on table
@@ -369,7 +425,16 @@ class SoftFocus(object):
         Callback function to show the main table with all tests
         """
         df = self.df
-        
+        current = df[self._catalog_filter(df)]
+        current = current.fillna('NaN')
+            
+        self.main_source.data = current.to_dict('list')
+    
+    
+    def _catalog_filter(self, df):
+        """
+        return the mask of catalog rows passing the main tab filters
+        """
         filt = ((df['last modification'] 
                    >= self.date_slider.value_as_datetime[0])
                 & (df['last modification'] 
@@ -396,10 +461,79 @@ class SoftFocus(object):
         except:
             self.csvname_text.value = ''
         
-        current = df[filt]
-        current = current.fillna('NaN')
-            
-        self.main_source.data = current.to_dict('list')
+        return filt
+    
+    
+    def push_catalog_diff(self, version, catalog, added, removed, modified):
+        """
+        Called from the folder watcher thread when the catalog changed
+        
+        Bokeh models may only be modified with the document lock, so the
+        changes are applied in a callback on the session's next tick.
+        """
+        self.document.add_next_tick_callback(partial(self.apply_catalog_diff,
+                                                     version,
+                                                     catalog,
+                                                     added,
+                                                     removed,
+                                                     modified))
+    
+    
+    def apply_catalog_diff(self, version, catalog, added, removed, modified):
+        """
+        Send the changed rows of the catalog to the main table
+        
+        Changed rows already shown in the table are patched, other changed
+        rows passing the filters are streamed. A ColumnDataSource can't drop
+        rows with stream or patch, so the whole table is sent again when
+        files are removed or when shown files no longer pass the filters.
+        Diffs not newer than the catalog of the session are skipped.
+        """
+        if version <= self.catalog_version:
+            return
+        self.catalog_version = version
+        self.df = catalog
+        
+        #let the date slider cover files newer than the last known date
+        old_end = self.date_slider.end
+        last_date = catalog['last modification'].max()
+        if len(catalog) and last_date > old_end:
+            self.date_slider.end = last_date
+            if self.date_slider.value_as_datetime[1].date() >= old_end:
+                #triggers update on the whole catalog
+                self.date_slider.value = (self.date_slider.value[0],
+                                          last_date)
+                return
+        
+        if removed:
+            self.update()
+            return
+        
+        view = self.main_source.data
+        columns = [c for c in view if c != 'index']
+        positions = dict((csv, i) for i, csv in enumerate(view['CSV']))
+        
+        changed = pd.concat([modified, added]).reset_index(drop=True)
+        shown = changed['CSV'].isin(list(positions))
+        passing = self._catalog_filter(changed)
+        if (shown & ~passing).any():
+            self.update()
+            return
+        changed = changed[passing].fillna('NaN')
+        shown = shown[passing]
+        patches = dict((c, []) for c in columns)
+        for c in columns:
+            for csv, value in zip(changed.loc[shown, 'CSV'],
+                                  changed.loc[shown, c].tolist()):
+                patches[c].append((positions[csv], value))
+        if shown.any():
+            self.main_source.patch(patches)
+        
+        new_rows = changed[~shown]
+        if len(new_rows):
+            new_rows = new_rows.reset_index()
+            self.main_source.stream(dict((c, new_rows[c].tolist())
+                                         for c in view))
         
     #callback function to add a plot tab
     @_wait_message_decorator
@@ -417,10 +551,20 @@ class SoftFocus(object):
         #plot controls
         
         logger.info("adding plot of {0}".format(self.sel_csv))
-        plot_df = pd.read_csv(os.path.join(self.data_dir, self.sel_csv),
-                              parse_dates=True,
-                              infer_datetime_format=True)
-        self.plot_dfs[self.sel_csv] = plot_df
+        csv_path = os.path.join(self.data_dir, self.sel_csv)
+        #windows are taken along the file's index column, 'time' or the
+        #first column (see rowindex), whatever the X-Axis selection
+        row_index = RowIndex(csv_path)
+        window = None
+        indexable = True
+        if os.path.getsize(csv_path) > LARGE_CSV_SIZE:
+            try:
+                window = row_index.window(WINDOW_ROWS)
+            except (ValueError, IndexError) as e:
+                #not sorted, or neither numbers nor dates: read it all
+                logger.warning("can't index {0}: {1}".format(self.sel_csv, e))
+                indexable = False
+        plot_df = self._load_plot_df(self.sel_csv, window)
         
         cols = plot_df.columns.tolist()
         x_sel = Select(title='X-Axis', 
@@ -431,6 +575,21 @@ class SoftFocus(object):
                        name='y_sel') 
         y_sel2 = Select(title='Y-Axis 2',value='None',options=cols+['None'], 
                         name='y_sel2')
+        #line plot of the rows or density image binned on the server
+        mode_sel = Select(title='View', value='line',
+                          options=['line', 'density'],
+                          name='mode_sel')
+        #the density view shows a single y-axis
+        mode_sel.on_change('value',
+                           lambda attr, old, new: setattr(y_sel2,
+                                                          'disabled',
+                                                          new == 'density'))
+        #rows read from the file, given as a range of its sorted column
+        window_text = TextInput(title='Rows where {0} in'.format(
+                                                            row_index.column),
+                                value=self._format_window(window),
+                                name='window_text',
+                                disabled=not indexable)
                
         #exit button
         exit_b = Button(label="Exit", button_type="success")
@@ -488,7 +647,8 @@ class SoftFocus(object):
         
         
         #plot controls together in a box
-        controls = widgetbox(plot_group_text,x_sel,y_sel,y_sel2,plot_b)
+        controls = widgetbox(plot_group_text,x_sel,y_sel,y_sel2,mode_sel,
+                             window_text,plot_b)
         #tab panel for this plot, differenciated with its name        
         plot_tab = Panel(child=row(column(controls,download_b,exit_b),
                                    Spacer(height=600, 
@@ -505,6 +665,88 @@ class SoftFocus(object):
         
         self.tabs.tabs.append(plot_tab)
         self.create_plot_figure(plot_tab)
+        self._enforce_memory_budget(keep=self.sel_csv)
+    
+    
+    def _load_plot_df(self, test, window=None):
+        """
+        read csv file test from the data folder and keep it in plot_dfs
+        
+        If window is a (start, end) tuple, only the rows where the sorted
+        column of the file is between start and end are parsed, using the
+        byte offset index of the file (see rowindex).
+        """
+        csv_path = os.path.join(self.data_dir, test)
+        if window is None:
+            plot_df = pd.read_csv(csv_path,
+                                  parse_dates=True,
+                                  infer_datetime_format=True)
+        else:
+            plot_df = RowIndex(csv_path).read_window(window[0],
+                                                     window[1],
+                                                     parse_dates=True,
+                                                     infer_datetime_format=True)
+        self.plot_dfs[test] = plot_df
+        self.plot_windows[test] = window
+        self.tab_last_view[test] = time.time()
+        return plot_df
+    
+    
+    def _free_plot_df(self, test):
+        """
+        forget the table of tab test, return the number of bytes freed
+        """
+        plot_df = self.plot_dfs.pop(test, None)
+        if plot_df is None:
+            return 0
+        return int(plot_df.memory_usage(deep=True).sum())
+    
+    
+    def _tab_memory(self, test, tabs):
+        """
+        bytes held for tab test: its table, twice if one of tabs plots it
+        """
+        plot_df = self.plot_dfs.get(test)
+        if plot_df is None:
+            return 0
+        size = int(plot_df.memory_usage(deep=True).sum())
+        for tab in tabs:
+            if tab.name == test and isinstance(tab.child.children[1], Plot):
+                #copy of the data in the line source or the density binning
+                return 2*size
+        return size
+    
+    
+    def _enforce_memory_budget(self, keep=None):
+        """
+        evict tables of the least recently viewed tabs above the budget
+        
+        The tables of the active tab and of tab keep are never evicted.
+        Evicted tabs stay open with an empty plot, their table is read again
+        when they are viewed (see view_plot_tab).
+        """
+        sizes = dict((test, self._tab_memory(test, self.tabs.tabs))
+                     for test in self.plot_dfs)
+        used = sum(sizes.values())
+        if used <= SESSION_MEMORY_BUDGET:
+            return
+        keep = set([keep, self.tabs.tabs[self.tabs.active].name])
+        freed = 0
+        for test in sorted(sizes, key=lambda t: self.tab_last_view.get(t, 0)):
+            if used - freed <= SESSION_MEMORY_BUDGET:
+                break
+            if test in keep:
+                continue
+            freed += sizes[test]
+            self._free_plot_df(test)
+            #the plot holds a copy of the data in its source, drop it too
+            for tab in self.tabs.tabs:
+                if tab.name == test:
+                    tab.child.children[1] = Spacer(height=600, width=600)
+            logger.info("evicted {0} from memory".format(test))
+        if freed:
+            logger.info('memory budget exceeded, {0:.1f} kB freed'.format(
+                                                                freed/1024))
     
     
     @_wait_message_decorator
@@ -526,8 +768,64 @@ class SoftFocus(object):
         """
         tab_ix = self.tabs.active
         active_tab = self.tabs.tabs[tab_ix]
+        test = active_tab.name
+        window = self._parse_window(active_tab)
+        if window != self.plot_windows.get(test):
+            logger.info("reading {0} in window {1}".format(test, window))
+            window_text = active_tab.select_one({'name':'window_text'})
+            try:
+                self._load_plot_df(test, window)
+            except TypeError:
+                #bounds of the wrong kind, e.g. dates for a column of numbers
+                window_text.value = self._format_window(
+                                                self.plot_windows.get(test))
+                raise
+            except (ValueError, IndexError):
+                #the file can't be indexed, only whole reads are possible
+                window_text.value = ''
+                window_text.disabled = True
+                raise
+            self._enforce_memory_budget(keep=test)
         #col of widgets in place 0, plot in place 1
         self.create_plot_figure(active_tab)
+    
+    
+    @staticmethod
+    def _format_window(window):
+        """
+        text of the window input, empty for the whole file
+        """
+        if window is None:
+            return ''
+        return '{0}..{1}'.format(*window)
+    
+    
+    def _parse_window(self, active_tab):
+        """
+        return the window typed in the tab, None for the whole file
+        
+        If the text can't be parsed, the window already read is kept.
+        """
+        window_text = active_tab.select_one({'name':'window_text'})
+        text = window_text.value.strip()
+        if not text:
+            return None
+        
+        def bound(i):
+            #number, or date for columns of dates
+            try:
+                return float(i)
+            except ValueError:
+                return pd.Timestamp(i)
+        
+        try:
+            start, end = [bound(i) for i in text.split('..')]
+            return (min(start, end), max(start, end))
+        except:
+            window = self.plot_windows.get(active_tab.name)
+            window_text.value = (self._format_window(window)
+                                 or "fmt: '100..200'")
+            return window
         
     
     
@@ -540,10 +838,19 @@ class SoftFocus(object):
         test = active_tab.name#contains csv filename
         x_sel=active_tab.select_one({'name':'x_sel'}) 
         y_sel=active_tab.select_one({'name':'y_sel'}) 
-        y_sel2=active_tab.select_one({'name':'y_sel2'}) 
+        y_sel2=active_tab.select_one({'name':'y_sel2'})
+        mode_sel=active_tab.select_one({'name':'mode_sel'})
         plot_df = self.plot_dfs[test]
-        source = ColumnDataSource(plot_df) 
-         
+
+        if mode_sel.value == 'density':
+            p = self._create_density_figure(plot_df,
+                                            x_sel.value,
+                                            y_sel.value)
+            active_tab.child.children[1] = p
+            return p
+
+        source = ColumnDataSource(plot_df)
+
         #Replace entirely p with a new plot 
         p = Plot( 
                  x_range=DataRange1d(),  
@@ -613,7 +920,109 @@ class SoftFocus(object):
                      )
         active_tab.child.children[1] = p
         return p
-        
+
+
+    def _create_density_figure(self, plot_df, x_col, y_col):
+        """
+        create a plot showing the density of y_col against x_col.
+
+        The rows are binned on the server into a 2D histogram with one bin
+        per pixel of the plot frame, sent as a single Image glyph. The histogram is
+        computed again for the visible ranges every time the plot is zoomed
+        or panned, so the payload does not depend on the number of rows.
+        """
+        x = plot_df[x_col].values.astype(np.float64)
+        y = plot_df[y_col].values.astype(np.float64)
+        (x0, x1), (y0, y1) = data_bounds(x, y)
+
+        #explicit ranges: DataRange1d can't follow the bounds of an image
+        #explicit borders: the frame inside the axes and title is known
+        #before the client lays out the plot
+        p = Plot(
+                 x_range=Range1d(x0, x1),
+                 y_range=Range1d(y0, y1),
+                 plot_height=600,
+                 plot_width=600,
+                 min_border_left=70,
+                 min_border_right=20,
+                 min_border_top=40,
+                 min_border_bottom=50,
+                 title=Title(text=self.sel_csv),
+                 name='plot')
+        p.add_tools(BoxZoomTool(),
+                    SaveTool(),
+                    ResetTool(),
+                    PanTool(),
+                    HoverTool(tooltips=[('x','$x'),
+                                        ('y','$y'),
+                                        ('count','@image')]))
+
+        def frame_size():
+            #size of the frame reported by the client if this bokeh version
+            #syncs it, otherwise the plot size minus the borders
+            width = getattr(p, 'inner_width', None)
+            height = getattr(p, 'inner_height', None)
+            if not width or not height:
+                width = p.plot_width - p.min_border_left - p.min_border_right
+                height = p.plot_height - p.min_border_top - p.min_border_bottom
+            return int(width), int(height)
+
+        width, height = frame_size()
+        source = ColumnDataSource(density_image_data(x, y,
+                                                     (x0, x1),
+                                                     (y0, y1),
+                                                     width,
+                                                     height))
+        color_mapper = LogColorMapper(palette='Viridis256',
+                                      low=1,
+                                      nan_color=(0, 0, 0, 0))
+        p.add_glyph(source,
+                    Image(image='image',
+                          x='x',
+                          y='y',
+                          dw='dw',
+                          dh='dh',
+                          color_mapper=color_mapper),
+                    name='ly_density')
+
+        p.add_layout(LinearAxis(
+                axis_label = x_col,
+                ticker=BasicTicker(desired_num_ticks =10),
+                name='x_axis'),'below')
+        p.add_layout(LinearAxis(
+                axis_label = y_col,
+                ticker=BasicTicker(desired_num_ticks =10),
+                name='y_axis'),'left')
+
+        #a zoom or pan changes start and end of both ranges one after the
+        #other: bin once, on next tick, when all of them are known
+        pending = False
+
+        def rebin():
+            nonlocal pending
+            pending = False
+            x_range = (p.x_range.start, p.x_range.end)
+            y_range = (p.y_range.start, p.y_range.end)
+            if None in x_range or None in y_range:
+                return
+            width, height = frame_size()
+            source.data = density_image_data(x, y, x_range, y_range,
+                                             width, height)
+
+        def schedule_rebin(attr, old, new):
+            nonlocal pending
+            if not pending:
+                pending = True
+                self.document.add_next_tick_callback(rebin)
+
+        for rng in (p.x_range, p.y_range):
+            rng.on_change('start', schedule_rebin)
+            rng.on_change('end', schedule_rebin)
+        if 'inner_width' in p.properties():
+            p.on_change('inner_width', schedule_rebin)
+            p.on_change('inner_height', schedule_rebin)
+        return p
+
     #callback function to remove a tab
     def remove_current_tab(self):
         """
@@ -624,7 +1033,21 @@ class SoftFocus(object):
             return#do nothing if main tab where all tests are   
                 
         #self.tabs.tabs.pop(tab_ix)
+        #its data is freed by changed_tabs_cb
         del self.tabs.tabs[tab_ix]
+    
+    
+    def release(self):
+        """
+        Free the data of all tabs, called when the session is destroyed
+        """
+        freed = 0
+        for test in list(self.plot_dfs):
+            freed += self._free_plot_df(test)
+        self.tab_last_view.clear()
+        self.plot_windows.clear()
+        logger.info('session {0} destroyed, {1:.1f} kB freed'.format(
+                                                self.session_id, freed/1024))
         
 
 
@@ -639,7 +1062,10 @@ class SoftFocus(object):
         p=active_tab.select_one({'name':'plot'})
         session_id= str(self.document.session_context._id)
         ly = p.select_one({'name':'ly'})
-        data = pd.DataFrame(ly.data_source.data) 
+        if ly is None:#density view, the image source only holds counts
+            data = self.plot_dfs[test]
+        else:
+            data = pd.DataFrame(ly.data_source.data)
         dirpath = os.path.join(os.path.dirname(__file__),'static','uploads')
         if not os.path.exists(dirpath):
             os.makedirs(dirpath)
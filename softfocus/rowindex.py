@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+sparse byte offset index of a csv file sorted along one column.
+
+Every INDEX_STEP rows, the value of the sorted column (e.g. time) and the
+byte offset of the row are recorded. A window of that column can then be
+read by seeking to the closest recorded rows around it and parsing only the
+bytes in between, instead of parsing the whole file.
+
+The index is saved next to the csv file (sample.csv -> sample.csv.idx). It
+is built on first access and, when the file grew since (e.g. a log still
+being written), extended from the last indexed row. Only plain csv files are
+supported: one row per line, no quoted separators. The sorted column holds
+numbers or dates, dates being indexed as nanoseconds since epoch (UTC).
+"""
+
+import io
+import json
+import numbers
+import os
+from bisect import bisect_left, bisect_right
+
+import pandas as pd
+
+INDEX_STEP = 10000
+INDEX_SUFFIX = '.idx'
+
+
+class RowIndex(object):
+    """sparse index of csv file csv_path along column
+
+    If column is None, 'time' is used if it is a column of the file,
+    otherwise the first column.
+    """
+
+    def __init__(self, csv_path, column=None, step=INDEX_STEP):
+        self.csv_path = csv_path
+        self.index_path = csv_path + INDEX_SUFFIX
+        self.step = step
+        with open(csv_path, 'rb') as f:
+            self.header = f.readline()
+        columns = self.header.decode().strip().split(',')
+        if column is None:
+            column = 'time' if 'time' in columns else columns[0]
+        self.column = column
+        self._col_ix = columns.index(column)
+        self._loaded = False
+
+    def update(self):
+        """load, build or extend the index so it covers the whole file"""
+        if not self._loaded:
+            self._loaded = True
+            if not self._load():
+                self._reset()
+        size = os.path.getsize(self.csv_path)
+        if size < self.size or not self._still_valid():
+            #the file was truncated or rewritten
+            self._reset()
+        if size > self.size:
+            self._extend()
+            self._save()
+
+    def window(self, rows):
+        """return (start, end) of column covering about the first rows"""
+        self.update()
+        if not self.keys:
+            return None
+        last = min(rows // self.step, len(self.keys) - 1)
+        return (self._from_key(self.keys[0]), self._from_key(self.keys[last]))
+
+    def read_window(self, start, end, **kwargs):
+        """return a DataFrame with the rows where start <= column <= end
+
+        start and end are numbers, or dates (Timestamp or string) if the
+        column holds dates. kwargs are passed to pandas.read_csv
+        """
+        self.update()
+        start, end = self._to_key(start), self._to_key(end)
+        #last recorded row strictly before start: rows from there on may
+        #be in the window, rows before can't
+        lo = bisect_left(self.keys, start) - 1
+        first = self.offsets[lo] if lo >= 0 else len(self.header)
+        #first recorded row after end: neither it nor the rows after are
+        hi = bisect_right(self.keys, end)
+        last = self.offsets[hi] if hi < len(self.offsets) else self.size
+        with open(self.csv_path, 'rb') as f:
+            f.seek(first)
+            chunk = f.read(max(last - first, 0))
+        df = pd.read_csv(io.BytesIO(self.header + chunk), **kwargs)
+        x = df[self.column]
+        if self.kind == 'datetime':
+            #compare dates, not int64 values: the resolution of parsed dates
+            #depends on the pandas version while keys are in nanoseconds
+            x = pd.to_datetime(x, utc=True)
+            start = pd.Timestamp(start, tz='UTC')
+            end = pd.Timestamp(end, tz='UTC')
+        return df[(x >= start) & (x <= end)].reset_index(drop=True)
+
+    def _parse_key(self, field):
+        """return the key of a csv field
+
+        The first parsed field sets whether the column holds numbers or
+        dates.
+        """
+        text = field.decode().strip().strip('"')
+        if self.kind is None:
+            try:
+                float(text)
+                self.kind = 'number'
+            except ValueError:
+                self.kind = 'datetime'
+        if self.kind == 'number':
+            return float(text)
+        #raises ValueError if not a date either
+        return int(pd.Timestamp(text).value)
+
+    def _to_key(self, value):
+        """return the key of a window bound, TypeError if of wrong kind"""
+        is_number = isinstance(value, numbers.Real)
+        if self.kind == 'datetime':
+            if is_number:
+                raise TypeError('{0} holds dates, not numbers'.format(
+                                                                self.column))
+            return int(pd.Timestamp(value).value)
+        if not is_number:
+            raise TypeError('{0} holds numbers, not dates'.format(
+                                                                self.column))
+        return float(value)
+
+    def _from_key(self, key):
+        if self.kind == 'datetime':
+            return pd.Timestamp(key)
+        return key
+
+    def _reset(self):
+        self.kind = None#'number' or 'datetime', set by the first row
+        self.keys = []#column value of every step-th row
+        self.offsets = []#byte offset of the same rows
+        self.rows = 0#number of indexed rows
+        self.size = len(self.header)#bytes indexed, ends with a full row
+
+    def _extend(self):
+        """index the rows written after the last indexed one"""
+        offset = self.size
+        with open(self.csv_path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break#row still being written, index it next time
+                if line.strip():
+                    if self.rows % self.step == 0:
+                        try:
+                            field = line.split(b',')[self._col_ix]
+                        except IndexError:
+                            raise ValueError(
+                                    '{0}: row too short at byte {1}'.format(
+                                            self.csv_path, offset))
+                        key = self._parse_key(field)
+                        if self.keys and key < self.keys[-1]:
+                            raise ValueError(
+                                    '{0} is not sorted along {1}'.format(
+                                            self.csv_path, self.column))
+                        self.keys.append(key)
+                        self.offsets.append(offset)
+                    self.rows += 1
+                offset += len(line)
+        self.size = offset
+
+    def _still_valid(self):
+        """check that the last recorded row was not changed since indexed"""
+        if not self.keys:
+            return True
+        with open(self.csv_path, 'rb') as f:
+            if f.readline() != self.header:
+                return False
+            f.seek(self.offsets[-1])
+            try:
+                key = self._parse_key(f.readline().split(b',')[self._col_ix])
+            except (ValueError, IndexError):
+                return False
+        return key == self.keys[-1]
+
+    def _load(self):
+        """read the saved index, return False if missing or not usable"""
+        try:
+            with open(self.index_path) as f:
+                saved = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        if (saved.get('column') != self.column
+            or saved.get('step') != self.step
+            or saved.get('header') != self.header.decode()):
+            return False
+        self.kind = saved.get('kind')
+        self.keys = saved['keys']
+        self.offsets = saved['offsets']
+        self.rows = saved['rows']
+        self.size = saved['size']
+        return True
+
+    def _save(self):
+        saved = {'column': self.column,
+                 'step': self.step,
+                 'header': self.header.decode(),
+                 'kind': self.kind,
+                 'keys': self.keys,
+                 'offsets': self.offsets,
+                 'rows': self.rows,
+                 'size': self.size,
+                 }
+        tmp_path = self.index_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(saved, f)
+            os.replace(tmp_path, self.index_path)
+        except (IOError, OSError):
+            pass#read-only folder: the index is built again next time
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+"""
+bokeh server lifecycle hooks of softfocus
+
+bokeh serve picks up this file automatically when serving the softfocus
+folder.
+"""
+
+import sessions
+
+
+def on_session_destroyed(session_context):
+    """free the data held by a session when its browser tab is gone"""
+    soft_focus = sessions.unregister(str(session_context.id))
+    if soft_focus is not None:
+        soft_focus.release()
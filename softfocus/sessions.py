@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+registry of the SoftFocus instances of the open bokeh sessions.
+
+main.py is executed again for each new session, so module level variables
+in main.py are not shared between sessions. This module is imported like a
+regular module and is kept in sys.modules, so the registry below is shared
+by all sessions and by the server lifecycle hooks (see server_lifecycle.py).
+"""
+
+import threading
+
+_lock = threading.Lock()
+_sessions = dict()#session id -> SoftFocus instance
+
+
+def register(session_id, soft_focus):
+    """keep a reference to the SoftFocus instance of a session"""
+    with _lock:
+        _sessions[session_id] = soft_focus
+
+
+def unregister(session_id):
+    """forget a session, return its SoftFocus instance or None if unknown"""
+    with _lock:
+        return _sessions.pop(session_id, None)
+
+
+def instances():
+    """return a list of the SoftFocus instances of all open sessions"""
+    with _lock:
+        return list(_sessions.values())
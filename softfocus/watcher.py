@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+watch a csv folder and keep a catalog of its files up to date.
+
+A single FolderWatcher per folder runs in a background thread and is shared
+by all sessions (see sessions.py). It compares successive listings of the
+folder to find added, removed and modified csv files, updates the shared
+catalog and hands the changed rows over to the sessions, which push them to
+their main table with stream/patch.
+
+The folder is listed with os.scandir, which gets size and modification time
+of each file in a single pass. If the optional inotify_simple package is
+installed (Linux only), the thread sleeps until the kernel reports a change
+in the folder instead of waking up at every poll interval. It still lists
+the folder every INOTIFY_TIMEOUT seconds in case an event was missed.
+"""
+
+import os
+import threading
+import time
+from datetime import date
+
+import pandas as pd
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+#local imports
+import sessions
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+#seconds between two listings of the folder without inotify
+POLL_INTERVAL = 2.
+#maximum seconds waiting for an inotify event before listing anyway
+INOTIFY_TIMEOUT = 300.
+#milliseconds to gather inotify events, a file being written triggers many
+INOTIFY_DELAY = 500
+
+CATALOG_COLUMNS = ['CSV', 'size (kB)', 'last modification', 'number of columns']
+
+_lock = threading.Lock()
+_watchers = dict()#absolute folder path -> FolderWatcher
+
+
+def get_watcher(data_dir):
+    """return the watcher of folder data_dir, started on first call"""
+    key = os.path.abspath(data_dir)
+    with _lock:
+        watcher = _watchers.get(key)
+        if watcher is None:
+            watcher = FolderWatcher(data_dir)
+            watcher.start()
+            _watchers[key] = watcher
+    return watcher
+
+
+def scan_folder(data_dir):
+    """return a dict csv file name -> (size, modification time)"""
+    snapshot = dict()
+    for entry in os.scandir(data_dir):
+        if entry.name.endswith('.csv') and entry.is_file():
+            csv_stat = entry.stat()
+            snapshot[entry.name] = (csv_stat.st_size, csv_stat.st_mtime)
+    return snapshot
+
+
+def catalog_rows(data_dir, snapshot, names):
+    """return a DataFrame with the catalog rows of csv files names"""
+    csv_dic = {'CSV': list(names),
+               'size (kB)':[],
+               'last modification':[],
+               'number of columns':[],
+               }
+    for csv in csv_dic['CSV']:
+        size, mtime = snapshot[csv]
+        csv_dic['size (kB)'].append(size/1024)
+        csv_dic['last modification'].append(date.fromtimestamp(mtime))
+        with open(os.path.join(data_dir,csv),'rb') as f:
+            csv_dic['number of columns'].append(
+                                len(f.readline().decode().split(','))
+                                )
+    return pd.DataFrame(csv_dic, columns=CATALOG_COLUMNS)
+
+
+class FolderWatcher(threading.Thread):
+    """background thread keeping the catalog of a csv folder up to date"""
+
+    def __init__(self, data_dir):
+        super(FolderWatcher, self).__init__(name='watcher ' + data_dir)
+        self.daemon = True
+        self.data_dir = data_dir
+        self._lock = threading.Lock()
+        self._version = 0#incremented with each new catalog
+        self._snapshot = scan_folder(data_dir)
+        self._catalog = catalog_rows(data_dir,
+                                     self._snapshot,
+                                     sorted(self._snapshot))
+
+    @property
+    def catalog(self):
+        """current catalog, a DataFrame never modified in place"""
+        with self._lock:
+            return self._catalog
+
+    def versioned_catalog(self):
+        """return (version, catalog), version increasing with each change"""
+        with self._lock:
+            return self._version, self._catalog
+
+    def run(self):
+        inotify = None
+        if INotify is not None:
+            try:
+                inotify = INotify()
+                inotify.add_watch(self.data_dir,
+                                  flags.CREATE | flags.DELETE
+                                  | flags.CLOSE_WRITE | flags.MODIFY
+                                  | flags.MOVED_FROM | flags.MOVED_TO)
+            except OSError:
+                logger.warning('inotify unavailable, polling'
+                               ' {0}'.format(self.data_dir))
+                inotify = None
+        while True:
+            if inotify is None:
+                time.sleep(POLL_INTERVAL)
+            else:
+                inotify.read(timeout=int(INOTIFY_TIMEOUT*1000),
+                             read_delay=INOTIFY_DELAY)
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('failed to refresh catalog of'
+                                 ' {0}'.format(self.data_dir))
+
+    def refresh(self):
+        """list the folder again and push the differences to the sessions"""
+        snapshot = scan_folder(self.data_dir)
+        old = self._snapshot
+        added = sorted(set(snapshot) - set(old))
+        removed = sorted(set(old) - set(snapshot))
+        modified = sorted(csv for csv in set(snapshot) & set(old)
+                          if snapshot[csv] != old[csv])
+        if not (added or removed or modified):
+            return
+
+        added_rows = catalog_rows(self.data_dir, snapshot, added)
+        modified_rows = catalog_rows(self.data_dir, snapshot, modified)
+        catalog = self._catalog
+        catalog = catalog[~catalog['CSV'].isin(removed + modified)]
+        catalog = pd.concat([catalog, modified_rows, added_rows])
+        catalog = catalog.sort_values('CSV').reset_index(drop=True)
+        with self._lock:
+            self._snapshot = snapshot
+            self._catalog = catalog
+            self._version += 1
+            version = self._version
+        logger.info('{0}: {1} added, {2} removed, {3} modified'.format(
+                    self.data_dir, len(added), len(removed), len(modified)))
+
+        #the catalog is already updated: a failing session must not keep
+        #the diff from the others
+        for soft_focus in sessions.instances():
+            if soft_focus.watcher is not self:
+                continue
+            try:
+                soft_focus.push_catalog_diff(version,
+                                             catalog,
+                                             added_rows,
+                                             removed,
+                                             modified_rows)
+            except Exception:
+                logger.exception('failed to push catalog diff to session'
+                                 ' {0}'.format(soft_focus.session_id))